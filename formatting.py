@@ -0,0 +1,52 @@
+# formatting.py
+# Turns cached market data into the text returned by the MCP tools. Shared by
+# ir_client, which formats each update once, and server.
+
+# Number of orders shown per side of the book, and of recent trades shown
+ORDER_BOOK_DEPTH = 5
+RECENT_TRADES_DEPTH = 5
+
+def format_ticker_data(data: dict) -> str:
+    """Formats ticker data into a human-readable string."""
+    return (
+        f"Ticker for {data['PrimaryCurrencyCode']}/{data['SecondaryCurrencyCode']}:\n"
+        f"  - Last Price: {data.get('LastPrice', 'N/A')}\n"
+        f"  - Best Bid: {data.get('BestBid', 'N/A')}\n"
+        f"  - Best Ask: {data.get('BestAsk', 'N/A')}\n"
+        f"  - 24h Volume: {data.get('Volume24Hour', 'N/A')}"
+    )
+
+def _append_orders(lines: list, orders: list) -> None:
+    """Appends the top of one side of an order book, one order per line."""
+    for order in orders[:ORDER_BOOK_DEPTH]:
+        lines.append(f"  - {order['Price']} ({order['Volume']})")
+
+def format_order_book_data(data: dict) -> str:
+    """Formats order book data into a human-readable string."""
+    lines = [
+        f"Order Book for {data['PrimaryCurrencyCode']}/{data['SecondaryCurrencyCode']}:",
+        f"--- Top {ORDER_BOOK_DEPTH} Bids (Buy Orders) ---",
+    ]
+    _append_orders(lines, data.get('BuyOrders', ()))
+    lines.append("")
+    lines.append(f"--- Top {ORDER_BOOK_DEPTH} Asks (Sell Orders) ---")
+    _append_orders(lines, data.get('SellOrders', ()))
+    return "\n".join(lines)
+
+def format_recent_trades_data(data: dict) -> str:
+    """Formats recent trades data into a human-readable string."""
+    lines = [f"Recent Trades for {data['PrimaryCurrencyCode']}/{data['SecondaryCurrencyCode']}:"]
+    for trade in data.get('Trades', ())[:RECENT_TRADES_DEPTH]:
+        lines.append(f"  - Price: {trade['Price']}, Volume: {trade['Volume']}")
+    return "\n".join(lines)
+
+def format_balance_data(data: dict) -> str:
+    """Formats balance data into a human-readable string."""
+    if not data:
+        return "No balance information available."
+
+    formatted_balances = "\n".join(
+        [f"  - {bal['CurrencyCode']}: Total: {bal.get('TotalBalance', 'N/A')}, Available: {bal.get('AvailableBalance', 'N/A')}"
+         for bal in data.values()]
+    )
+    return f"Your Balances:\n{formatted_balances}"
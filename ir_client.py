@@ -1,184 +1,591 @@
 # ir_client.py
+import aiohttp
 import asyncio
-import json
+from array import array
 import os
 import logging
+import math
+import re
+import sys
+import threading
 import websockets
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+from websockets.protocol import State
+from websockets.sync.client import ClientConnection, connect
 from dotenv import load_dotenv
 import time
 import hmac
 import hashlib
-from collections import OrderedDict
+import heapq
+from formatting import format_order_book_data, format_recent_trades_data, format_ticker_data
+
+# orjson parses frames several times faster than the stdlib decoder; fall back
+# to json if it isn't installed. Outgoing frames stay str so they go out as text.
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+
+    _loads = json.loads
+    _dumps = json.dumps
 
 load_dotenv()
 
 # Configure structured logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 CACHE_TIMEOUT = 300  # 5 minutes
 
+# Market data channel prefixes, shared by the dispatch table and callers building channels
+TICKER = "ticker"
+ORDER_BOOK = "orderbook"
+RECENT_TRADES = "recenttrades"
+
+PRIVATE_CHANNELS = frozenset(["balance", "orders", "trades"])
+
+# Ticker fields kept in per-field columns, and the marker for a missing value.
+# Columns hold floats, so integer prices come back (and are shown) as e.g. 4.0.
+TICKER_FIELDS = ("LastPrice", "BestBid", "BestAsk", "Volume24Hour")
+_MISSING = float("nan")
+
+# Queued by the reader thread after each (re)connect so the event loop resubscribes
+_CONNECTED = object()
+# Upper bound on frames handed to the event loop in one batch
+_MAX_FRAME_BATCH = 64
+# Upper bound on batches waiting for the event loop. Once it is reached the reader
+# thread stops reading and frames back up in the socket instead of in memory.
+_MAX_QUEUED_BATCHES = 256
+# Seconds to wait before reconnecting after the connection drops
+RECONNECT_DELAY = 5
+
+# Public (un)subscribe frames are fixed apart from the channel name, which is
+# always plain ASCII, so they're rendered from a template instead of encoded
+_SUBSCRIBE_TEMPLATE = '{"m":"subscribe","n":"%s"}'
+_UNSUBSCRIBE_TEMPLATE = '{"m":"unsubscribe","n":"%s"}'
+
+# Market data frames are cached undecoded and only parsed when a tool reads them
+_MARKET_CHANNEL_RE = re.compile(rb'"n"\s*:\s*"((ticker|orderbook|recenttrades)-[^"]*)"')
+# Error and event frames carry a top-level "e" key; they go through the full
+# parser even when they name a market data channel. Only the envelope ahead of
+# the "o" payload is searched, so snapshots aren't scanned end to end.
+_EVENT_RE = re.compile(rb'"e"\s*:')
+
+# Order book snapshots are verbose JSON that permessage-deflate shrinks several
+# times over, saving bandwidth and socket reads on the feed that matters most.
+# Only our small subscribe frames are compressed locally, so a lower memLevel
+# keeps the compressor's footprint down.
+_DEFLATE = ClientPerMessageDeflateFactory(compress_settings={"memLevel": 4})
+
+class _ClientConnection(ClientConnection):
+    # Read up to 1 MiB per recv() so order book snapshots arrive in a few large
+    # chunks instead of many 64 KiB ones that each get copied into the parser
+    recv_bufsize = 2**20
+
+
 class IndependentReserveWebSocketClient:
     def __init__(self):
         self.ws_url = "wss://ws.independentreserve.com/v2"
+        self.rest_url = "https://api.independentreserve.com/Public"
         self.api_key = os.getenv("IR_API_KEY")
         self.api_secret = os.getenv("IR_API_SECRET")
+        self._hmac_key = self.api_secret.encode('utf-8') if self.api_secret else None
         
-        # Caches to store the latest data from the WebSocket
-        self.tickers = {}
+        # Caches to store the latest data from the WebSocket. Tickers are stored
+        # column-wise: one float array per field, indexed by a per-pair id.
+        self._pair_ids = {}
+        self._ticker_pairs = []
+        self._ticker_columns = {field: array('d') for field in TICKER_FIELDS}
+        # Dicts handed out by get_latest_ticker, reused until the pair updates
+        self._ticker_views = {}
         self.order_books = {}
         self.recent_trades = {}
         self.balances = {}
-        self.subscription_cache = OrderedDict()
+        # Currency codes the exchange trades, loaded from the REST API on connect
+        # and retried on each reconnect until it succeeds. While they are None,
+        # every pair is let through to the WebSocket.
+        self._primary_codes = None
+        self._secondary_codes = None
+        # Formatted text per cache key, paired with the payload it was built
+        # from, so each update is formatted once however often it is read
+        self._ticker_text = {}
+        self._order_book_text = {}
+        self._recent_trades_text = {}
+        # Expiry time per subscribed channel, plus a min-heap of (expiry, channel)
+        # so the manager can sleep until the next one is due. Refreshing a
+        # subscription only updates the dict; stale heap entries are skipped.
+        self.subscription_expiry = {}
+        self._expiry_heap = []
+        self._expiry_scheduled = asyncio.Event()
+        # Channels asked for by request(), subscribed to by a background task
+        self._pending = set()
+        self._pending_added = asyncio.Event()
+
+        # Maps a market data channel prefix to the function storing its payloads
+        self._channel_handlers = {
+            TICKER: self._store_ticker,
+            ORDER_BOOK: self.order_books.__setitem__,
+            RECENT_TRADES: self.recent_trades.__setitem__,
+        }
+        # Cache keys per (primary, secondary) pair and per subscribed channel, and
+        # channel names per (prefix, primary, secondary) as passed in by tool calls,
+        # so neither the read path nor the message handlers rebuild them
+        self._key_cache = {}
+        self._channel_to_key = {}
+        self._channel_names = {}
 
         self.websocket = None
+        # Background tasks started by connect(), held until they finish
+        self._tasks = set()
+        self._codes_task = None
+        self._frames = None
         self._running = False
         self.active_subscriptions = set()
 
     async def connect(self):
-        """Connects to the WebSocket, listens for messages, and manages subscriptions."""
+        """Starts the WebSocket reader thread and processes its frames on the event loop."""
         if self._running:
             return
         self._running = True
-        logging.info("Connecting to Independent Reserve WebSocket...")
-        
-        asyncio.create_task(self._manage_subscriptions())
+        logger.info("Connecting to Independent Reserve WebSocket...")
+
+        self._start_task(self._manage_subscriptions())
+        self._start_task(self._subscribe_pending())
+        self._codes_task = self._start_task(self._load_currency_codes())
+
+        self._frames = asyncio.Queue()
+        self._batch_slots = threading.Semaphore(_MAX_QUEUED_BATCHES)
+        reader = threading.Thread(
+            target=self._read_frames,
+            args=(asyncio.get_running_loop(),),
+            name="ir-websocket-reader",
+            daemon=True)
+        reader.start()
+
+        while True:
+            batch = await self._frames.get()
+            if batch is None:
+                # stop() was called; closing the socket unblocks the reader thread
+                if self.websocket is not None:
+                    await asyncio.to_thread(self.websocket.close)
+                break
+            if batch is _CONNECTED:
+                # Resubscribe to channels after reconnecting, and pick up any
+                # requested while the connection was down
+                await self._resubscribe_all()
+                self._pending_added.set()
+                # Retry loading the currency codes if every attempt so far failed
+                if self._primary_codes is None and self._codes_task.done():
+                    self._codes_task = self._start_task(self._load_currency_codes())
+                continue
+
+            self._batch_slots.release()
+            for frame in batch:
+                try:
+                    self._handle_frame(frame)
+                except ValueError:
+                    logger.error("Failed to decode JSON: %s", frame)
+                except Exception as e:
+                    logger.error("An unexpected error occurred while handling a frame: %s", e)
+
+    def _start_task(self, coro):
+        """Runs a coroutine as a background task, held until it finishes."""
+        task = asyncio.create_task(coro, name=coro.__name__)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task):
+        """Forgets a finished background task, logging it if it failed."""
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background task %s failed: %s", task.get_name(), task.exception())
+
+    async def _load_currency_codes(self):
+        """Fetches the valid primary and secondary currency codes from the public REST API."""
+        async def fetch(session, method):
+            async with session.get(f"{self.rest_url}/{method}") as response:
+                response.raise_for_status()
+                return _loads(await response.read())
+
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+                primary, secondary = await asyncio.gather(
+                    fetch(session, "GetValidPrimaryCurrencyCodes"),
+                    fetch(session, "GetValidSecondaryCurrencyCodes"))
+            primary_codes = frozenset(code.lower() for code in primary)
+            secondary_codes = frozenset(code.lower() for code in secondary)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, TypeError, AttributeError) as e:
+            logger.warning("Failed to load currency codes, pairs won't be checked until a reconnect: %s", e)
+            return
 
+        self._primary_codes = primary_codes
+        self._secondary_codes = secondary_codes
+        logger.info("Loaded %d primary and %d secondary currency codes",
+                    len(primary_codes), len(secondary_codes))
+
+    def _read_frames(self, loop):
+        """Reads frames on a worker thread and hands them to the event loop.
+
+        Keeping socket reads off the event loop leaves it free to answer tool calls
+        while large order book snapshots are being received.
+        """
+        put = self._frames.put_nowait
         while self._running:
             try:
-                async with websockets.connect(self.ws_url) as websocket:
+                # Order book snapshots can exceed the default 1 MiB frame limit
+                # (max_size is only a cap; buffers aren't allocated up front).
+                with connect(
+                    self.ws_url,
+                    max_size=4 * 2**20,
+                    ping_interval=20,
+                    ping_timeout=20,
+                    extensions=[_DEFLATE],
+                    create_connection=_ClientConnection,
+                ) as websocket:
                     self.websocket = websocket
-                    logging.info("WebSocket connection established.")
-                    # Resubscribe to channels after reconnecting
-                    await self._resubscribe_all()
-                    
-                    async for message in websocket:
+                    logger.info("WebSocket connection established.")
+                    loop.call_soon_threadsafe(put, _CONNECTED)
+
+                    while True:
+                        # Take the raw frame bytes: the JSON parser rejects invalid
+                        # UTF-8 anyway, so decoding to str first is wasted work.
+                        # Block for one frame, then take whatever else is already
+                        # buffered so the event loop is woken once per batch.
+                        batch = [websocket.recv(decode=False)]
                         try:
-                            await self._handle_message(json.loads(message))
-                        except json.JSONDecodeError:
-                            logging.error(f"Failed to decode JSON: {message}")
-            except (websockets.ConnectionClosedError, ConnectionRefusedError) as e:
-                logging.warning(f"WebSocket connection lost: {e}. Reconnecting in 5 seconds...")
-                await asyncio.sleep(5)
+                            while len(batch) < _MAX_FRAME_BATCH:
+                                batch.append(websocket.recv(timeout=0, decode=False))
+                        except TimeoutError:
+                            pass
+                        finally:
+                            self._queue_batch(loop, batch)
+            except (websockets.ConnectionClosed, OSError) as e:
+                if not self._running:
+                    break
+                logger.warning("WebSocket connection lost: %s. Reconnecting in %s seconds...", e, RECONNECT_DELAY)
+                time.sleep(RECONNECT_DELAY)
             except Exception as e:
-                logging.error(f"An unexpected error occurred: {e}. Reconnecting in 5 seconds...")
-                await asyncio.sleep(5)
+                logger.error("An unexpected error occurred: %s. Reconnecting in %s seconds...", e, RECONNECT_DELAY)
+                time.sleep(RECONNECT_DELAY)
+
+    def _queue_batch(self, loop, batch):
+        """Hands a batch to the event loop, waiting while too many are queued."""
+        while not self._batch_slots.acquire(timeout=1):
+            if not self._running:
+                return
+        loop.call_soon_threadsafe(self._frames.put_nowait, batch)
+
+    async def _send(self, frame):
+        """Sends a frame without blocking the event loop on the socket write."""
+        await asyncio.to_thread(self.websocket.send, frame)
+
+    @property
+    def connected(self):
+        """Whether the WebSocket connection is currently open."""
+        return self.websocket is not None and self.websocket.state is State.OPEN
 
     async def _manage_subscriptions(self):
-        """Periodically checks for and unsubscribes from expired channels."""
+        """Unsubscribes from channels as their subscriptions expire."""
         while self._running:
-            now = time.time()
-            expired_channels = [
-                channel for channel, sub_time in self.subscription_cache.items()
-                if now - sub_time > CACHE_TIMEOUT
-            ]
+            if not self._expiry_heap:
+                self._expiry_scheduled.clear()
+                await self._expiry_scheduled.wait()
+                continue
+
+            expires_at, channel = self._expiry_heap[0]
+            delay = expires_at - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            heapq.heappop(self._expiry_heap)
+            current = self.subscription_expiry.get(channel)
+            if current is None:
+                continue  # Already unsubscribed
+            if current > expires_at:
+                # Refreshed since this entry was pushed
+                heapq.heappush(self._expiry_heap, (current, channel))
+                continue
 
-            for channel in expired_channels:
+            try:
                 await self._unsubscribe(channel)
+            except websockets.ConnectionClosed:
+                logger.warning("Failed to unsubscribe from %s, connection closed.", channel)
+            if channel in self.subscription_expiry:
+                # Not connected right now, try again in a minute
+                heapq.heappush(self._expiry_heap, (time.time() + 60, channel))
 
-            await asyncio.sleep(60)  # Check every minute
+    async def _subscribe_pending(self):
+        """Subscribes to channels queued by request() while connected."""
+        while self._running:
+            await self._pending_added.wait()
+            self._pending_added.clear()
+            if not self._pending or not self.connected:
+                continue  # Anything queued is picked up again on reconnect
+
+            channels, self._pending = self._pending, set()
+            for channel in channels:
+                try:
+                    await self.ensure_subscribed(channel)
+                except websockets.ConnectionClosed:
+                    logger.warning("Failed to subscribe to %s, connection closed.", channel)
+                    self._pending.add(channel)
+                except Exception as e:
+                    logger.error("Failed to subscribe to %s: %s", channel, e)
+
+    def _schedule_expiry(self, channel, expires_at):
+        """Records when a channel's subscription expires."""
+        if channel not in self.subscription_expiry:
+            heapq.heappush(self._expiry_heap, (expires_at, channel))
+            self._expiry_scheduled.set()
+        self.subscription_expiry[channel] = expires_at
+
+    def _handle_frame(self, frame):
+        """Caches order book and trade frames as raw bytes; everything else is parsed and routed."""
+        envelope_end = frame.find(b'"o"')
+        if _EVENT_RE.search(frame, 0, envelope_end if envelope_end >= 0 else len(frame)):
+            match = None
+        else:
+            match = _MARKET_CHANNEL_RE.search(frame)
+        key = self._channel_key(match[1].decode()) if match else None
+        if key is None:
+            self._handle_message(_loads(frame))
+            return
 
-    async def _handle_message(self, data):
+        self._channel_handlers[match[2].decode()](key, frame)
+
+    def _handle_message(self, data):
         """Routes incoming messages to the correct handler based on the channel."""
-        event = data.get("e")
-        if event == "error":
+        # Error and other event frames carry "e" and no channel data; hand them
+        # off before any channel parsing
+        if "e" in data:
             self._handle_error(data)
             return
 
-        channel = data.get("n")
-        payload = data.get("o")
-        
-        if not channel or not payload:
-            logging.warning(f"Received malformed message: {data}")
-            return
-
-        if channel.startswith("ticker"):
-            key = payload['PrimaryCurrencyCode'].lower() + payload['SecondaryCurrencyCode'].lower()
-            self.tickers[key] = payload
-        elif channel.startswith("orderbook"):
-            key = payload['PrimaryCurrencyCode'].lower() + payload['SecondaryCurrencyCode'].lower()
-            self.order_books[key] = payload
-        elif channel.startswith("recenttrades"):
-            key = payload['PrimaryCurrencyCode'].lower() + payload['SecondaryCurrencyCode'].lower()
-            self.recent_trades[key] = payload
-        elif channel == "balance":
-            for currency_balance in payload:
-                self.balances[currency_balance['CurrencyCode'].lower()] = currency_balance
+        # Well-formed frames always carry "n" and "o", so index them directly and
+        # leave anything missing to the (rare) malformed-message handler
+        try:
+            channel = data["n"]
+            payload = data["o"]
+
+            store = self._channel_handlers.get(channel.partition("-")[0])
+            if store is not None:
+                key = self._channel_key(channel)
+                if key is None:
+                    raise KeyError(channel)
+                store(key, payload)
+            elif channel == "balance":
+                for currency_balance in payload:
+                    self.balances[currency_balance['CurrencyCode'].lower()] = currency_balance
+        except (KeyError, TypeError, AttributeError):
+            logger.warning("Received malformed message: %s", data)
+
+    def _channel_key(self, channel):
+        """Returns the cache key for a market data channel, read from the pair in its name.
+
+        Channels subscribed through market_channel are already mapped; any other
+        (e.g. "ticker-xbt-usd") is mapped on first sight. Returns None if the
+        name doesn't carry a valid pair.
+        """
+        key = self._channel_to_key.get(channel)
+        if key is None:
+            key = channel.partition("-")[2].replace("-", "").lower()
+            if not (key.isascii() and key.isalnum()):
+                return None
+            key = self._channel_to_key[channel] = sys.intern(key)
+        return key
+
+    def _store_ticker(self, key, payload):
+        """Writes a ticker snapshot into the per-field columns."""
+        if isinstance(payload, bytes):
+            message = _loads(payload)
+            if "e" in message:
+                # An event frame whose "e" came after the payload
+                self._handle_error(message)
+                return
+            payload = message["o"]
+        pair = (payload['PrimaryCurrencyCode'], payload['SecondaryCurrencyCode'])
+
+        pair_id = self._pair_ids.get(key)
+        if pair_id is None:
+            pair_id = self._pair_ids[key] = len(self._ticker_pairs)
+            self._ticker_pairs.append(None)
+            for column in self._ticker_columns.values():
+                column.append(_MISSING)
+
+        self._ticker_pairs[pair_id] = pair
+        self._ticker_views.pop(pair_id, None)
+        for field, column in self._ticker_columns.items():
+            try:
+                column[pair_id] = float(payload[field])
+            except (KeyError, TypeError, ValueError):
+                column[pair_id] = _MISSING
 
     def _handle_error(self, data):
-        """Handles error messages from the WebSocket."""
+        """Handles error and other event messages from the WebSocket."""
         error_message = data.get("o", "Unknown error")
-        logging.error(f"Received error from server: {error_message}")
+        if data["e"] == "error":
+            logger.error("Received error from server: %s", error_message)
+        else:
+            logger.warning("Received %s event from server: %s", data["e"], error_message)
+
+    def _sign(self, channel, nonce=None):
+        """Builds the HMAC-SHA256 authentication payload for a private channel."""
+        if nonce is None:
+            nonce = str(int(time.time()))
+
+        parameters_for_signature = [
+            'apiKey=' + self.api_key,
+            'nonce=' + nonce,
+            'channel=' + channel
+        ]
+
+        message_to_sign = ','.join(parameters_for_signature)
+
+        signature = hmac.new(
+            self._hmac_key,
+            msg=message_to_sign.encode('utf-8'),
+            digestmod=hashlib.sha256).hexdigest().upper()
+
+        return {
+            "apiKey": self.api_key,
+            "nonce": nonce,
+            "signature": signature
+        }
+
+    def is_subscribed(self, channel):
+        """Returns whether a channel has a live subscription, refreshing its expiry if so."""
+        now = time.time()
+        if now < self.subscription_expiry.get(channel, 0):
+            self.subscription_expiry[channel] = now + CACHE_TIMEOUT
+            return True
+        return False
 
     async def _subscribe(self, channel, is_private=False):
         """Sends a subscription message if not already subscribed or if the subscription has expired."""
         now = time.time()
 
-        if channel in self.subscription_cache and now - self.subscription_cache[channel] < CACHE_TIMEOUT:
-            self.subscription_cache[channel] = now  # Refresh the timestamp
+        if self.is_subscribed(channel):
             return
 
         if self.websocket:
-            message = {"m": "subscribe", "n": channel}
-
             if is_private:
                 if not self.api_key or not self.api_secret:
-                    logging.error("API key and secret are required for private channels.")
+                    logger.error("API key and secret are required for private channels.")
                     return
 
-                nonce = str(int(time.time()))
-
-                parameters_for_signature = [
-                    'apiKey=' + self.api_key,
-                    'nonce=' + nonce,
-                    'channel=' + channel
-                ]
-
-                message_to_sign = ','.join(parameters_for_signature)
-
-                signature = hmac.new(
-                    self.api_secret.encode('utf-8'),
-                    msg=message_to_sign.encode('utf-8'),
-                    digestmod=hashlib.sha256).hexdigest().upper()
-
-                auth_payload = {
-                    "apiKey": self.api_key,
-                    "nonce": nonce,
-                    "signature": signature
-                }
+                frame = _dumps({"m": "subscribe", "n": channel, "o": self._sign(channel)})
+            else:
+                frame = _SUBSCRIBE_TEMPLATE % channel
 
-                message["o"] = auth_payload
-
-            await self.websocket.send(json.dumps(message))
+            await self._send(frame)
             self.active_subscriptions.add(channel)
-            self.subscription_cache[channel] = now
-            logging.info(f"Subscribed to {channel}")
+            self._schedule_expiry(channel, now + CACHE_TIMEOUT)
+            logger.info("Subscribed to %s", channel)
 
     async def _unsubscribe(self, channel):
         """Sends an unsubscription message."""
         if channel not in self.active_subscriptions:
             return
 
-        if self.websocket:
-            message = {"m": "unsubscribe", "n": channel}
-            await self.websocket.send(json.dumps(message))
+        if self.connected:
+            await self._send(_UNSUBSCRIBE_TEMPLATE % channel)
             self.active_subscriptions.discard(channel)
-            del self.subscription_cache[channel]
-            logging.info(f"Unsubscribed from {channel}")
+            del self.subscription_expiry[channel]
+            self._drop_cached(channel)
+            logger.info("Unsubscribed from %s", channel)
+
+    def _drop_cached(self, channel):
+        """Forgets a channel's cached data so it isn't served once the feed has stopped."""
+        if channel == "balance":
+            self.balances.clear()
+            return
+
+        key = self._channel_to_key.get(channel)
+        if key is None:
+            return
+        prefix = channel.partition("-")[0]
+        if prefix == TICKER:
+            pair_id = self._pair_ids.get(key)
+            if pair_id is not None:
+                # Keep the pair's slot in the columns for when it is resubscribed
+                self._ticker_pairs[pair_id] = None
+                self._ticker_views.pop(pair_id, None)
+                for column in self._ticker_columns.values():
+                    column[pair_id] = _MISSING
+            self._ticker_text.pop(key, None)
+        elif prefix == ORDER_BOOK:
+            self.order_books.pop(key, None)
+            self._order_book_text.pop(key, None)
+        elif prefix == RECENT_TRADES:
+            self.recent_trades.pop(key, None)
+            self._recent_trades_text.pop(key, None)
+
+    def _pair_key(self, primary_currency, secondary_currency):
+        """Returns the cache key for a currency pair, building it only once per pair.
+
+        Keys are interned so every spelling of a pair maps to the same string
+        object and cache lookups match on identity before comparing characters.
+        """
+        pair = (primary_currency, secondary_currency)
+        key = self._key_cache.get(pair)
+        if key is None:
+            key = self._key_cache[pair] = sys.intern((primary_currency + secondary_currency).lower())
+        return key
+
+    def is_valid_pair(self, primary_currency, secondary_currency):
+        """Whether the exchange trades both currencies; always True until the codes are loaded."""
+        if self._primary_codes is None:
+            return True
+        return (primary_currency.lower() in self._primary_codes
+                and secondary_currency.lower() in self._secondary_codes)
+
+    def market_channel(self, prefix, primary_currency, secondary_currency):
+        """Returns the channel name for a market data feed and remembers its cache key."""
+        request = (prefix, primary_currency, secondary_currency)
+        channel = self._channel_names.get(request)
+        if channel is not None:
+            return channel
+
+        key = self._pair_key(primary_currency, secondary_currency)
+        if not (key.isascii() and key.isalnum()):
+            raise ValueError(f"Invalid currency pair: {primary_currency}/{secondary_currency}")
+        channel = self._channel_names[request] = f"{prefix}-{key}"
+        self._channel_to_key[channel] = key
+        return channel
+
+    def request(self, channel):
+        """Queues a subscription to a channel built by market_channel, or to a
+        private channel, without waiting for it to be sent.
+
+        A live subscription just has its expiry refreshed.
+        """
+        if self.is_subscribed(channel):
+            return
+        self._pending.add(channel)
+        self._pending_added.set()
+
+    async def ensure_subscribed(self, channel):
+        """Subscribes to a channel built by market_channel, or to a private channel."""
+        await self._subscribe(channel, is_private=channel in PRIVATE_CHANNELS)
 
     async def subscribe_ticker(self, primary_currency, secondary_currency):
         """Subscribes to the ticker channel for a given currency pair."""
-        channel = f"ticker-{primary_currency.lower()}{secondary_currency.lower()}"
-        await self._subscribe(channel)
+        await self._subscribe(self.market_channel(TICKER, primary_currency, secondary_currency))
 
     async def subscribe_order_book(self, primary_currency, secondary_currency):
         """Subscribes to the order book channel."""
-        channel = f"orderbook-{primary_currency.lower()}{secondary_currency.lower()}"
-        await self._subscribe(channel)
+        await self._subscribe(self.market_channel(ORDER_BOOK, primary_currency, secondary_currency))
 
     async def subscribe_recent_trades(self, primary_currency, secondary_currency):
         """Subscribes to the recent trades channel."""
-        channel = f"recenttrades-{primary_currency.lower()}{secondary_currency.lower()}"
-        await self._subscribe(channel)
+        await self._subscribe(self.market_channel(RECENT_TRADES, primary_currency, secondary_currency))
 
     async def subscribe_balance(self):
         """Subscribes to the balance channel."""
@@ -189,62 +596,113 @@ class IndependentReserveWebSocketClient:
         if not self.websocket or not self.active_subscriptions:
             return
 
-        logging.info(f"Resubscribing to {len(self.active_subscriptions)} channels...")
-        for channel in list(self.active_subscriptions):
-            is_private = channel in ["balance", "orders", "trades"]
-
-            message = {"m": "subscribe", "n": channel}
+        logger.info("Resubscribing to %s channels...", len(self.active_subscriptions))
+        frames = {}
+        # There are at most a handful of private channels, so signing them inline
+        # is cheaper than a hop to an executor; they share one nonce per batch
+        nonce = str(int(time.time()))
+        # Nothing awaits inside this loop, so the set can't change under us
+        for channel in self.active_subscriptions:
+            is_private = channel in PRIVATE_CHANNELS
 
             if is_private:
                 if not self.api_key or not self.api_secret:
-                    logging.error(f"Cannot resubscribe to private channel {channel} without API key and secret.")
+                    logger.error("Cannot resubscribe to private channel %s without API key and secret.", channel)
                     continue
 
-                nonce = str(int(time.time()))
-
-                parameters_for_signature = [
-                    'apiKey=' + self.api_key,
-                    'nonce=' + nonce,
-                    'channel=' + channel
-                ]
-
-                message_to_sign = ','.join(parameters_for_signature)
-
-                signature = hmac.new(
-                    self.api_secret.encode('utf-8'),
-                    msg=message_to_sign.encode('utf-8'),
-                    digestmod=hashlib.sha256).hexdigest().upper()
+                frames[channel] = _dumps({"m": "subscribe", "n": channel, "o": self._sign(channel, nonce)})
+            else:
+                frames[channel] = _SUBSCRIBE_TEMPLATE % channel
 
-                auth_payload = {
-                    "apiKey": self.api_key,
-                    "nonce": nonce,
-                    "signature": signature
-                }
-
-                message["o"] = auth_payload
+        # The API takes one subscription per frame, so pipeline the sends rather
+        # than waiting for each write to drain before queuing the next one.
+        try:
+            await asyncio.gather(*(self._send(frame) for frame in frames.values()))
+        except websockets.ConnectionClosed:
+            logger.warning("Failed to resubscribe, connection closed.")
+            return
 
+        now = time.time()
+        for channel in frames:
+            self._schedule_expiry(channel, now + CACHE_TIMEOUT)
+            logger.info("Successfully resubscribed to %s", channel)
+
+    def _get_latest(self, cache, primary_currency, secondary_currency):
+        """Returns a cached payload, decoding it first if it is still a raw frame."""
+        key = self._pair_key(primary_currency, secondary_currency)
+        data = cache.get(key)
+        if isinstance(data, bytes):
             try:
-                await self.websocket.send(json.dumps(message))
-                self.subscription_cache[channel] = time.time()
-                logging.info(f"Successfully resubscribed to {channel}")
-            except websockets.ConnectionClosed:
-                logging.warning(f"Failed to resubscribe to {channel}, connection closed.")
-                break
+                message = _loads(data)
+                data = message["o"]
+            except (ValueError, KeyError, TypeError):
+                data = None
+            # Only market data payloads are served; an error or event frame that
+            # got cached, or a payload without its currency codes (which tickers
+            # reject on arrival), is dropped rather than handed to the formatters
+            if (not isinstance(data, dict) or "e" in message
+                    or "PrimaryCurrencyCode" not in data or "SecondaryCurrencyCode" not in data):
+                logger.error("Dropping cached frame for %s that isn't valid market data", key)
+                del cache[key]
+                return None
+            cache[key] = data
+        return data
 
     def get_latest_ticker(self, primary_currency, secondary_currency):
         """Retrieves the latest cached ticker data."""
-        key = f"{primary_currency.lower()}{secondary_currency.lower()}"
-        return self.tickers.get(key)
+        pair_id = self._pair_ids.get(self._pair_key(primary_currency, secondary_currency))
+        if pair_id is None or self._ticker_pairs[pair_id] is None:
+            return None
+
+        data = self._ticker_views.get(pair_id)
+        if data is not None:
+            return data
+
+        primary_code, secondary_code = self._ticker_pairs[pair_id]
+        data = {"PrimaryCurrencyCode": primary_code, "SecondaryCurrencyCode": secondary_code}
+        for field, column in self._ticker_columns.items():
+            value = column[pair_id]
+            if not math.isnan(value):  # NaN marks a missing field
+                data[field] = value
+        self._ticker_views[pair_id] = data
+        return data
 
     def get_latest_order_book(self, primary_currency, secondary_currency):
         """Retrieves the latest cached order book data."""
-        key = f"{primary_currency.lower()}{secondary_currency.lower()}"
-        return self.order_books.get(key)
+        return self._get_latest(self.order_books, primary_currency, secondary_currency)
 
     def get_latest_recent_trades(self, primary_currency, secondary_currency):
         """Retrieves the latest cached recent trades data."""
-        key = f"{primary_currency.lower()}{secondary_currency.lower()}"
-        return self.recent_trades.get(key)
+        return self._get_latest(self.recent_trades, primary_currency, secondary_currency)
+
+    def _get_formatted(self, texts, key, data, format_data):
+        """Returns the text for a cached payload, formatting it on the first read after an update."""
+        if data is None:
+            return None
+        entry = texts.get(key)
+        if entry is not None and entry[0] is data:
+            return entry[1]
+        text = format_data(data)
+        texts[key] = (data, text)
+        return text
+
+    def get_latest_ticker_formatted(self, primary_currency, secondary_currency):
+        """Retrieves the latest cached ticker data as text."""
+        return self._get_formatted(
+            self._ticker_text, self._pair_key(primary_currency, secondary_currency),
+            self.get_latest_ticker(primary_currency, secondary_currency), format_ticker_data)
+
+    def get_latest_order_book_formatted(self, primary_currency, secondary_currency):
+        """Retrieves the latest cached order book data as text."""
+        return self._get_formatted(
+            self._order_book_text, self._pair_key(primary_currency, secondary_currency),
+            self.get_latest_order_book(primary_currency, secondary_currency), format_order_book_data)
+
+    def get_latest_recent_trades_formatted(self, primary_currency, secondary_currency):
+        """Retrieves the latest cached recent trades data as text."""
+        return self._get_formatted(
+            self._recent_trades_text, self._pair_key(primary_currency, secondary_currency),
+            self.get_latest_recent_trades(primary_currency, secondary_currency), format_recent_trades_data)
 
     def get_my_balance(self):
         """Retrieves all cached balances."""
@@ -253,3 +711,9 @@ class IndependentReserveWebSocketClient:
     def stop(self):
         """Stops the client."""
         self._running = False
+        self._expiry_scheduled.set()
+        self._pending_added.set()
+        for task in self._tasks:
+            task.cancel()
+        if self._frames is not None:
+            self._frames.put_nowait(None)
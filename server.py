@@ -1,161 +1,158 @@
 import asyncio
+import functools
 import logging
 from mcp.server import Server
 from mcp.types import Tool, TextContent
-from ir_client import IndependentReserveWebSocketClient
+from formatting import format_balance_data
+from ir_client import ORDER_BOOK, RECENT_TRADES, TICKER, IndependentReserveWebSocketClient
+
+# uvloop runs the event loop on libuv, which cuts per-callback and socket I/O
+# overhead; it is POSIX-only, so fall back to the default loop without it.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Configure structured logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # Initialize the MCP server and our WebSocket client
 server = Server("independentreserve-mcp")
 ir_client = IndependentReserveWebSocketClient()
 
+# The tool definitions are static, so build them once rather than on every request.
+# The market data tools all take the same currency pair arguments.
+_CURRENCY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "primary_currency": {"type": "string", "description": "The primary currency code, e.g., 'Xbt' or 'Eth'"},
+        "secondary_currency": {"type": "string", "description": "The secondary currency code, e.g., 'Usd' or 'Aud'"}
+    },
+    "required": ["primary_currency", "secondary_currency"]
+}
+
+_TOOLS = [
+    Tool(
+        name="get_ticker",
+        description="Gets the latest ticker information for a cryptocurrency pair, including last price, bid, ask, and volume.",
+        inputSchema=_CURRENCY_SCHEMA
+    ),
+    Tool(
+        name="get_recent_trades",
+        description="Gets the most recent trades for a cryptocurrency pair.",
+        inputSchema=_CURRENCY_SCHEMA
+    ),
+    Tool(
+        name="get_order_book",
+        description="Gets the latest order book (top 50 bids and asks) for a cryptocurrency pair.",
+        inputSchema=_CURRENCY_SCHEMA
+    ),
+    Tool(
+        name="get_my_balance",
+        description="Gets the current balance for all currencies in your account.",
+        inputSchema={}
+    )
+]
+
 @server.list_tools()
 async def handle_list_tools() -> list[Tool]:
     """Returns the list of available tools to the AI."""
-    return [
-        Tool(
-            name="get_ticker",
-            description="Gets the latest ticker information for a cryptocurrency pair, including last price, bid, ask, and volume.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "primary_currency": {"type": "string", "description": "The primary currency code, e.g., 'Xbt' or 'Eth'"},
-                    "secondary_currency": {"type": "string", "description": "The secondary currency code, e.g., 'Usd' or 'Aud'"}
-                },
-                "required": ["primary_currency", "secondary_currency"]
-            }
-        ),
-        Tool(
-            name="get_recent_trades",
-            description="Gets the most recent trades for a cryptocurrency pair.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "primary_currency": {"type": "string", "description": "The primary currency code, e.g., 'Xbt' or 'Eth'"},
-                    "secondary_currency": {"type": "string", "description": "The secondary currency code, e.g., 'Usd' or 'Aud'"}
-                },
-                "required": ["primary_currency", "secondary_currency"]
-            }
-        ),
-        Tool(
-            name="get_order_book",
-            description="Gets the latest order book (top 50 bids and asks) for a cryptocurrency pair.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "primary_currency": {"type": "string", "description": "The primary currency code, e.g., 'Xbt' or 'Eth'"},
-                    "secondary_currency": {"type": "string", "description": "The secondary currency code, e.g., 'Usd' or 'Aud'"}
-                },
-                "required": ["primary_currency", "secondary_currency"]
-            }
-        ),
-        Tool(
-            name="get_my_balance",
-            description="Gets the current balance for all currencies in your account.",
-            inputSchema={}
-        )
-    ]
-
-def _format_ticker_data(data: dict) -> str:
-    """Formats ticker data into a human-readable string."""
-    return (
-        f"Ticker for {data['PrimaryCurrencyCode']}/{data['SecondaryCurrencyCode']}:\n"
-        f"  - Last Price: {data.get('LastPrice', 'N/A')}\n"
-        f"  - Best Bid: {data.get('BestBid', 'N/A')}\n"
-        f"  - Best Ask: {data.get('BestAsk', 'N/A')}\n"
-        f"  - 24h Volume: {data.get('Volume24Hour', 'N/A')}"
-    )
-
-def _format_order_book_data(data: dict) -> str:
-    """Formats order book data into a human-readable string."""
-    buys = data.get('BuyOrders', [])[:5]
-    sells = data.get('SellOrders', [])[:5]
-
-    formatted_buys = "\n".join([f"  - {order['Price']} ({order['Volume']})" for order in buys])
-    formatted_sells = "\n".join([f"  - {order['Price']} ({order['Volume']})" for order in sells])
-
-    return (
-        f"Order Book for {data['PrimaryCurrencyCode']}/{data['SecondaryCurrencyCode']}:\n"
-        f"--- Top 5 Bids (Buy Orders) ---\n{formatted_buys}\n\n"
-        f"--- Top 5 Asks (Sell Orders) ---\n{formatted_sells}"
-    )
-
-def _format_recent_trades_data(data: dict) -> str:
-    """Formats recent trades data into a human-readable string."""
-    trades = data.get('Trades', [])[:5]
-    formatted_trades = "\n".join([f"  - Price: {trade['Price']}, Volume: {trade['Volume']}" for trade in trades])
-    return f"Recent Trades for {data['PrimaryCurrencyCode']}/{data['SecondaryCurrencyCode']}:\n{formatted_trades}"
-
-def _format_balance_data(data: dict) -> str:
-    """Formats balance data into a human-readable string."""
-    if not data:
-        return "No balance information available."
-
-    formatted_balances = "\n".join(
-        [f"  - {bal['CurrencyCode']}: Total: {bal.get('TotalBalance', 'N/A')}, Available: {bal.get('AvailableBalance', 'N/A')}"
-         for bal in data.values()]
-    )
-    return f"Your Balances:\n{formatted_balances}"
+    return _TOOLS
+
+def _get_balance_text(primary_currency, secondary_currency):
+    """Formats the cached balances, or returns None until they arrive."""
+    data = ir_client.get_my_balance()
+    return format_balance_data(data) if data else None
+
+# Per tool: the channel to subscribe to, the getter for the cached data as text
+# and the message returned until data arrives. Market data is formatted once per
+# update by ir_client. The callables take the primary and secondary currency and
+# look ir_client up at call time so tests can patch it.
+_TOOL_HANDLERS = {
+    "get_ticker": (
+        lambda p, s: ir_client.market_channel(TICKER, p, s),
+        lambda p, s: ir_client.get_latest_ticker_formatted(p, s),
+        "Data for {0}/{1} is not available yet. Please try again in a moment.",
+    ),
+    "get_order_book": (
+        lambda p, s: ir_client.market_channel(ORDER_BOOK, p, s),
+        lambda p, s: ir_client.get_latest_order_book_formatted(p, s),
+        "Data for {0}/{1} is not available yet. Please try again in a moment.",
+    ),
+    "get_recent_trades": (
+        lambda p, s: ir_client.market_channel(RECENT_TRADES, p, s),
+        lambda p, s: ir_client.get_latest_recent_trades_formatted(p, s),
+        "Data for {0}/{1} is not available yet. Please try again in a moment.",
+    ),
+    "get_my_balance": (
+        lambda p, s: "balance",
+        _get_balance_text,
+        "Balance data is not available yet. Please try again in a moment.",
+    ),
+}
+
+# Replies that don't depend on the request are built once and shared
+_UNKNOWN_TOOL_RESP = [TextContent(type="text", text="Unknown tool.")]
+_MISSING_CURRENCY_RESP = [TextContent(type="text", text="Missing primary or secondary currency.")]
+_NOT_CONNECTED_RESP = [TextContent(type="text", text="WebSocket is not connected. Please wait a moment and try again.")]
+
+@functools.lru_cache(maxsize=64)
+def _not_ready(template: str, primary_currency: str, secondary_currency: str) -> list[TextContent]:
+    """Builds the reply sent until a pair's data arrives, reused while clients poll for it."""
+    return [TextContent(type="text", text=template.format(primary_currency, secondary_currency))]
+
+@functools.lru_cache(maxsize=64)
+def _invalid_pair(primary_currency: str, secondary_currency: str) -> list[TextContent]:
+    """Builds the reply for a currency pair the exchange doesn't trade."""
+    return [TextContent(type="text", text=f"Invalid currency pair: {primary_currency}/{secondary_currency}. Please check the currency codes and try again.")]
 
 @server.call_tool()
 async def handle_call_tool(name: str, arguments: dict) -> list[TextContent]:
     """Handles a tool call from the AI."""
+    handler = _TOOL_HANDLERS.get(name)
+    if handler is None:
+        logger.error("Unknown tool: %s", name)
+        return _UNKNOWN_TOOL_RESP
+
     primary_currency = arguments.get("primary_currency")
     secondary_currency = arguments.get("secondary_currency")
 
-    if name not in ["get_my_balance"] and (not primary_currency or not secondary_currency):
-        return [TextContent(type="text", text="Missing primary or secondary currency.")]
+    if name not in ["get_my_balance"]:
+        if not primary_currency or not secondary_currency:
+            return _MISSING_CURRENCY_RESP
 
-    if not ir_client.websocket or not ir_client.websocket.open:
-        return [TextContent(type="text", text="WebSocket is not connected. Please wait a moment and try again.")]
+        # Unknown currencies are turned away without touching the WebSocket
+        if not ir_client.is_valid_pair(primary_currency, secondary_currency):
+            logger.error("Invalid currency pair: %s/%s", primary_currency, secondary_currency)
+            return _invalid_pair(primary_currency, secondary_currency)
 
+    if not ir_client.connected:
+        return _NOT_CONNECTED_RESP
+
+    channel_for, get_text, not_ready = handler
     try:
-        if name == "get_ticker":
-            await ir_client.subscribe_ticker(primary_currency, secondary_currency)
-            await asyncio.sleep(1) # Give time for data to arrive
-            data = ir_client.get_latest_ticker(primary_currency, secondary_currency)
-            if not data:
-                return [TextContent(type="text", text=f"Data for {primary_currency}/{secondary_currency} is not available yet. Please try again in a moment.")]
-            return [TextContent(type="text", text=_format_ticker_data(data))]
-
-        elif name == "get_order_book":
-            await ir_client.subscribe_order_book(primary_currency, secondary_currency)
-            await asyncio.sleep(1) # Give time for data to arrive
-            data = ir_client.get_latest_order_book(primary_currency, secondary_currency)
-            if not data:
-                return [TextContent(type="text", text=f"Data for {primary_currency}/{secondary_currency} is not available yet. Please try again in a moment.")]
-            return [TextContent(type="text", text=_format_order_book_data(data))]
-
-        elif name == "get_recent_trades":
-            await ir_client.subscribe_recent_trades(primary_currency, secondary_currency)
-            await asyncio.sleep(1) # Give time for data to arrive
-            data = ir_client.get_latest_recent_trades(primary_currency, secondary_currency)
-            if not data:
-                return [TextContent(type="text", text=f"Data for {primary_currency}/{secondary_currency} is not available yet. Please try again in a moment.")]
-            return [TextContent(type="text", text=_format_recent_trades_data(data))]
-
-        elif name == "get_my_balance":
-            await ir_client.subscribe_balance()
-            await asyncio.sleep(1) # Give time for data to arrive
-            data = ir_client.get_my_balance()
-            if not data:
-                return [TextContent(type="text", text="Balance data is not available yet. Please try again in a moment.")]
-            return [TextContent(type="text", text=_format_balance_data(data))]
-        else:
-            logging.error(f"Unknown tool: {name}")
-            return [TextContent(type="text", text="Unknown tool.")]
-
-    except KeyError:
-        logging.error(f"Invalid currency pair: {primary_currency}/{secondary_currency}")
-        return [TextContent(type="text", text=f"Invalid currency pair: {primary_currency}/{secondary_currency}. Please check the currency codes and try again.")]
+        # Subscribing happens in the background; until the first update
+        # arrives the caller gets the not-ready message
+        ir_client.request(channel_for(primary_currency, secondary_currency))
+        text = get_text(primary_currency, secondary_currency)
+        if text is None:
+            return _not_ready(not_ready, primary_currency, secondary_currency)
+        return [TextContent(type="text", text=text)]
+
+    except (KeyError, ValueError):
+        logger.error("Invalid currency pair: %s/%s", primary_currency, secondary_currency)
+        return _invalid_pair(primary_currency, secondary_currency)
     except Exception as e:
-        logging.error(f"An error occurred while calling {name}: {e}")
+        logger.error("An error occurred while calling %s: %s", name, e)
         return [TextContent(type="text", text=f"An unexpected error occurred: {e}")]
 
 
 async def main():
+    # Make sure debug mode (e.g. from PYTHONASYNCIODEBUG or -X dev) doesn't add
+    # per-callback bookkeeping to the event loop
+    asyncio.get_running_loop().set_debug(False)
+
     # Start the WebSocket client in the background
     client_task = asyncio.create_task(ir_client.connect())
     
@@ -173,4 +170,7 @@ async def main():
     await client_task
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,77 @@
+import sys
+import os
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from formatting import format_balance_data, format_order_book_data, format_recent_trades_data, format_ticker_data
+
+class TestFormatting(unittest.TestCase):
+    def test_format_ticker(self):
+        text = format_ticker_data({
+            "PrimaryCurrencyCode": "Xbt",
+            "SecondaryCurrencyCode": "Usd",
+            "LastPrice": 50000.0,
+            "BestBid": 49990.0,
+        })
+
+        self.assertEqual(text, "\n".join([
+            "Ticker for Xbt/Usd:",
+            "  - Last Price: 50000.0",
+            "  - Best Bid: 49990.0",
+            "  - Best Ask: N/A",
+            "  - 24h Volume: N/A",
+        ]))
+
+    def test_format_order_book(self):
+        text = format_order_book_data({
+            "PrimaryCurrencyCode": "Eth",
+            "SecondaryCurrencyCode": "Aud",
+            "BuyOrders": [{"Price": 3000 - i, "Volume": 1} for i in range(7)],
+            "SellOrders": [{"Price": 3100, "Volume": 2}],
+        })
+
+        self.assertEqual(text, "\n".join([
+            "Order Book for Eth/Aud:",
+            "--- Top 5 Bids (Buy Orders) ---",
+            "  - 3000 (1)",
+            "  - 2999 (1)",
+            "  - 2998 (1)",
+            "  - 2997 (1)",
+            "  - 2996 (1)",
+            "",
+            "--- Top 5 Asks (Sell Orders) ---",
+            "  - 3100 (2)",
+        ]))
+
+    def test_format_depth(self):
+        with patch("formatting.ORDER_BOOK_DEPTH", 1), patch("formatting.RECENT_TRADES_DEPTH", 1):
+            book = format_order_book_data({
+                "PrimaryCurrencyCode": "Eth",
+                "SecondaryCurrencyCode": "Aud",
+                "BuyOrders": [{"Price": 3000, "Volume": 1}, {"Price": 2999, "Volume": 1}],
+            })
+            trades = format_recent_trades_data({
+                "PrimaryCurrencyCode": "Eth",
+                "SecondaryCurrencyCode": "Aud",
+                "Trades": [{"Price": 3000, "Volume": 1}, {"Price": 2999, "Volume": 1}],
+            })
+
+        self.assertEqual(book, "\n".join([
+            "Order Book for Eth/Aud:",
+            "--- Top 1 Bids (Buy Orders) ---",
+            "  - 3000 (1)",
+            "",
+            "--- Top 1 Asks (Sell Orders) ---",
+        ]))
+        self.assertEqual(trades, "Recent Trades for Eth/Aud:\n  - Price: 3000, Volume: 1")
+
+    def test_format_balance(self):
+        self.assertEqual(format_balance_data({}), "No balance information available.")
+        self.assertEqual(
+            format_balance_data({"Xbt": {"CurrencyCode": "Xbt", "TotalBalance": 1.5}}),
+            "Your Balances:\n  - Xbt: Total: 1.5, Available: N/A")
+
+if __name__ == '__main__':
+    unittest.main()
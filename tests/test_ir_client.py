@@ -1,39 +1,401 @@
 import sys
 import os
 import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
 import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from aiohttp import web
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+from websockets.protocol import State
+
 from ir_client import IndependentReserveWebSocketClient
 
-class TestIndependentReserveWebSocketClient(unittest.TestCase):
+class TestIndependentReserveWebSocketClient(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         self.client = IndependentReserveWebSocketClient()
 
     def test_handle_messages(self):
-        async def run_test():
-            messages = [
-                {"n": "ticker-xbt-usd", "o": {"PrimaryCurrencyCode": "Xbt", "SecondaryCurrencyCode": "Usd", "LastPrice": 50000.0}},
-                {"n": "orderbook-eth-aud", "o": {"PrimaryCurrencyCode": "Eth", "SecondaryCurrencyCode": "Aud", "BuyOrders": [{"Price": 3000, "Volume": 10}]}},
-                {"n": "recenttrades-btc-usd", "o": {"PrimaryCurrencyCode": "Btc", "SecondaryCurrencyCode": "Usd", "Trades": [{"Price": 60000, "Volume": 0.5}]}},
-                {"e": "error", "o": "Invalid currency pair"},
-            ]
+        messages = [
+            {"n": "ticker-xbt-usd", "o": {"PrimaryCurrencyCode": "Xbt", "SecondaryCurrencyCode": "Usd", "LastPrice": 50000.0}},
+            {"n": "orderbook-eth-aud", "o": {"PrimaryCurrencyCode": "Eth", "SecondaryCurrencyCode": "Aud", "BuyOrders": [{"Price": 3000, "Volume": 10}]}},
+            {"n": "recenttrades-btc-usd", "o": {"PrimaryCurrencyCode": "Btc", "SecondaryCurrencyCode": "Usd", "Trades": [{"Price": 60000, "Volume": 0.5}]}},
+            {"e": "error", "o": "Invalid currency pair"},
+            {"e": "heartbeat", "n": "ticker-xbt-usd", "o": {"PrimaryCurrencyCode": "Xbt", "SecondaryCurrencyCode": "Usd", "LastPrice": 1.0}},
+            {"n": "ticker-ethusd"},
+            {"n": "ticker-ethusd", "o": {"LastPrice": 1.0}},
+            {"n": "orderbook-", "o": {"BuyOrders": []}},
+        ]
+
+        for msg in messages:
+            self.client._handle_message(msg)
+
+        # Check that the data was cached correctly
+        ticker = self.client.get_latest_ticker("Xbt", "Usd")
+        self.assertEqual(ticker["LastPrice"], 50000.0)
+        self.assertNotIn("BestBid", ticker)
+
+        self.assertIn("ethaud", self.client.order_books)
+        self.assertEqual(self.client.order_books["ethaud"]["BuyOrders"][0]["Price"], 3000)
+
+        self.assertIn("btcusd", self.client.recent_trades)
+        self.assertEqual(self.client.recent_trades["btcusd"]["Trades"][0]["Price"], 60000)
+
+        # The cache key comes from the pair in the channel name
+        self.assertEqual(self.client._channel_to_key["orderbook-eth-aud"], "ethaud")
+
+        # Malformed messages are dropped
+        self.assertIsNone(self.client.get_latest_ticker("Eth", "Usd"))
+        self.assertEqual(list(self.client.order_books), ["ethaud"])
+
+    def test_handle_frame_defers_decoding(self):
+        frame = b'{"n":"recenttrades-btcusd","o":{"PrimaryCurrencyCode":"Btc","SecondaryCurrencyCode":"Usd","Trades":[{"Price":60000,"Volume":0.5}]}}'
+        self.client._handle_frame(frame)
+
+        # The raw frame is cached until something reads it
+        self.assertEqual(self.client.recent_trades["btcusd"], frame)
+        self.assertEqual(self.client.get_latest_recent_trades("Btc", "Usd")["Trades"][0]["Price"], 60000)
+        self.assertIsInstance(self.client.recent_trades["btcusd"], dict)
+
+        # Cached frames that turn out not to be market data are dropped on read
+        self.client.order_books["ethaud"] = b'{"e":"error","n":"orderbook-ethaud","o":"Invalid currency pair"}'
+        self.assertIsNone(self.client.get_latest_order_book("Eth", "Aud"))
+        self.assertNotIn("ethaud", self.client.order_books)
+
+        # Ticker frames are decoded straight into the ticker columns
+        self.client._handle_frame(b'{"n":"ticker-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","LastPrice":50000.0,"BestBid":49990}}')
+        ticker = self.client.get_latest_ticker("xbt", "usd")
+        self.assertEqual(ticker["BestBid"], 49990.0)
+
+        # Values are stored as floats, so integers read back as floats
+        self.client._handle_frame(b'{"n":"ticker-ethaud","o":{"PrimaryCurrencyCode":"Eth","SecondaryCurrencyCode":"Aud","LastPrice":4}}')
+        self.assertIn("Last Price: 4.0\n", self.client.get_latest_ticker_formatted("Eth", "Aud"))
+
+        # The same dict is handed out until the pair updates
+        self.assertIs(self.client.get_latest_ticker("Xbt", "Usd"), ticker)
+        self.client._handle_frame(b'{"n":"ticker-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","LastPrice":50001.0}}')
+        self.assertEqual(self.client.get_latest_ticker("Xbt", "Usd")["LastPrice"], 50001.0)
+
+        # Event frames naming a market data channel don't reach its cache
+        self.client._handle_frame(b'{"e":"heartbeat","n":"ticker-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","LastPrice":1.0}}')
+        self.assertEqual(self.client.get_latest_ticker("Xbt", "Usd")["LastPrice"], 50001.0)
+        self.client._handle_frame(b'{"n":"ticker-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","LastPrice":1.0},"e":"heartbeat"}')
+        self.assertEqual(self.client.get_latest_ticker("Xbt", "Usd")["LastPrice"], 50001.0)
+
+        # An "e" key inside the payload doesn't make it an event frame
+        frame = b'{"n":"recenttrades-btcusd","o":{"PrimaryCurrencyCode":"Btc","SecondaryCurrencyCode":"Usd","Trades":[{"e":1,"Price":1,"Volume":1}]}}'
+        self.client._handle_frame(frame)
+        self.assertIs(self.client.recent_trades["btcusd"], frame)
+
+        # Frames that aren't market data still go through the full parser
+        self.client._handle_frame(b'{"e":"error","o":"Invalid currency pair"}')
+        self.assertEqual(len(self.client.recent_trades), 1)
+
+        # Frames are parsed without a UTF-8 decode first, so the parser has to
+        # reject invalid UTF-8 itself
+        with self.assertRaises(ValueError):
+            self.client._handle_frame(b'{"n":"balance","o":"\xff"}')
+
+    def test_formatted_text_is_cached_per_update(self):
+        self.assertIsNone(self.client.get_latest_ticker_formatted("Xbt", "Usd"))
+
+        self.client._handle_frame(b'{"n":"ticker-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","LastPrice":50000.0}}')
+        text = self.client.get_latest_ticker_formatted("Xbt", "Usd")
+        self.assertIn("Last Price: 50000.0", text)
+        self.assertIs(self.client.get_latest_ticker_formatted("xbt", "usd"), text)
+
+        self.client._handle_frame(b'{"n":"ticker-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","LastPrice":50001.0}}')
+        self.assertIn("Last Price: 50001.0", self.client.get_latest_ticker_formatted("Xbt", "Usd"))
+
+        self.client._handle_frame(b'{"n":"orderbook-ethaud","o":{"PrimaryCurrencyCode":"Eth","SecondaryCurrencyCode":"Aud","BuyOrders":[{"Price":3000,"Volume":10}]}}')
+        text = self.client.get_latest_order_book_formatted("Eth", "Aud")
+        self.assertIn("  - 3000 (10)", text)
+        self.assertIs(self.client.get_latest_order_book_formatted("Eth", "Aud"), text)
+
+    async def test_subscribed_channel_maps_to_cache_key(self):
+        self.client.websocket = MagicMock()
+        await self.client.subscribe_order_book("Eth", "Aud")
+
+        frame = b'{"n":"orderbook-ethaud","o":{"PrimaryCurrencyCode":"Eth","SecondaryCurrencyCode":"Aud","BuyOrders":[{"Price":3000,"Volume":10}]}}'
+        self.client._handle_frame(frame)
+
+        self.assertEqual(self.client.order_books["ethaud"], frame)
+        self.assertIs(self.client._pair_key("ETH", "aud"), self.client._pair_key("Eth", "Aud"))
+        self.assertEqual(self.client.get_latest_order_book("Eth", "Aud")["BuyOrders"][0]["Price"], 3000)
+
+        # Payloads without their currency codes are dropped, as for tickers
+        self.client._handle_frame(b'{"n":"orderbook-ethaud","o":{"BuyOrders":[{"Price":3000,"Volume":10}]}}')
+        self.assertIsNone(self.client.get_latest_order_book("Eth", "Aud"))
+        self.assertIsNone(self.client.get_latest_order_book_formatted("Eth", "Aud"))
+
+        # Repeat requests for the same pair reuse the channel name
+        channel = self.client.market_channel("orderbook", "Eth", "Aud")
+        self.assertEqual(channel, "orderbook-ethaud")
+        self.assertIs(self.client.market_channel("orderbook", "Eth", "Aud"), channel)
+
+    async def test_request_subscribes_in_background(self):
+        self.client.websocket = MagicMock(state=State.OPEN)
+        self.client._running = True
+        task = asyncio.create_task(self.client._subscribe_pending())
+
+        channel = self.client.market_channel("ticker", "Xbt", "Usd")
+        self.client.request(channel)
+        self.client.websocket.send.assert_not_called()
+
+        await asyncio.sleep(0.01)
+        self.client.websocket.send.assert_called_once_with('{"m":"subscribe","n":"ticker-xbtusd"}')
+
+        # A live subscription isn't queued again
+        self.client.request(channel)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.client.websocket.send.call_count, 1)
+
+        # An unexpected failure is logged and doesn't stop later subscriptions
+        self.client.websocket.send.side_effect = [RuntimeError("boom"), None]
+        with self.assertLogs("ir_client", "ERROR"):
+            self.client.request(self.client.market_channel("ticker", "Eth", "Aud"))
+            await asyncio.sleep(0.01)
+        self.client.request(self.client.market_channel("ticker", "Eth", "Usd"))
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.client.websocket.send.call_args.args[0], '{"m":"subscribe","n":"ticker-ethusd"}')
+        self.assertFalse(task.done())
+
+        self.client.stop()
+        await task
+
+    def test_is_valid_pair(self):
+        # Nothing is rejected until the currency codes have been loaded
+        self.assertTrue(self.client.is_valid_pair("Foo", "Usd"))
+
+        self.client._primary_codes = frozenset(["xbt", "eth"])
+        self.client._secondary_codes = frozenset(["usd", "aud"])
+        self.assertTrue(self.client.is_valid_pair("Xbt", "AUD"))
+        self.assertFalse(self.client.is_valid_pair("Foo", "Usd"))
+        self.assertFalse(self.client.is_valid_pair("Usd", "Xbt"))
+
+    async def test_failed_background_task_is_logged(self):
+        async def fail():
+            raise RuntimeError("boom")
+
+        task = asyncio.create_task(fail(), name="fail")
+        self.client._tasks.add(task)
+        task.add_done_callback(self.client._on_task_done)
+
+        with self.assertLogs("ir_client", "ERROR") as logs:
+            await asyncio.wait([task])
+            await asyncio.sleep(0)
+
+        self.assertIn("Background task fail failed: boom", logs.output[0])
+        self.assertEqual(self.client._tasks, set())
+
+    async def test_subscribe_rejects_non_alphanumeric_pair(self):
+        self.client.websocket = MagicMock()
+        with self.assertRaises(ValueError):
+            await self.client.subscribe_ticker('Xbt"', "Usd")
+        self.client.websocket.send.assert_not_called()
+
+    def test_sign(self):
+        self.client.api_key = "key"
+        self.client._hmac_key = b"secret"
+
+        auth = self.client._sign("balance")
+
+        expected = hmac.new(
+            b"secret",
+            msg=f"apiKey=key,nonce={auth['nonce']},channel=balance".encode('utf-8'),
+            digestmod=hashlib.sha256).hexdigest().upper()
+        self.assertEqual(auth["apiKey"], "key")
+        self.assertEqual(auth["signature"], expected)
+
+    async def test_resubscribe_all(self):
+        self.client.websocket = MagicMock()
+        self.client.active_subscriptions = {"ticker-xbtusd", "orderbook-ethaud"}
+
+        await self.client._resubscribe_all()
+
+        sent = sorted(call.args[0] for call in self.client.websocket.send.call_args_list)
+        self.assertEqual(sent, [
+            '{"m":"subscribe","n":"orderbook-ethaud"}',
+            '{"m":"subscribe","n":"ticker-xbtusd"}',
+        ])
+        self.assertEqual(set(self.client.subscription_expiry), self.client.active_subscriptions)
+
+    async def test_manage_subscriptions_unsubscribes_expired(self):
+        self.client.websocket = MagicMock(state=State.OPEN)
+        self.client._running = True
+        self.client.active_subscriptions = {"ticker-xbtusd", "ticker-ethaud"}
+        self.client._schedule_expiry("ticker-xbtusd", time.time() - 1)
+        self.client._schedule_expiry("ticker-ethaud", time.time() + 60)
+
+        task = asyncio.create_task(self.client._manage_subscriptions())
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.client.active_subscriptions, {"ticker-ethaud"})
+        self.client.websocket.send.assert_called_once_with('{"m":"unsubscribe","n":"ticker-xbtusd"}')
+
+        task.cancel()
+
+    async def test_unsubscribe_drops_cached_data(self):
+        self.client.websocket = MagicMock(state=State.OPEN)
+        for prefix in ("ticker", "orderbook"):
+            await self.client.ensure_subscribed(self.client.market_channel(prefix, "Xbt", "Usd"))
+            self.client._handle_frame(b'{"n":"%s-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","LastPrice":1.0}}' % prefix.encode())
+        self.assertIsNotNone(self.client.get_latest_ticker_formatted("Xbt", "Usd"))
+        self.assertIsNotNone(self.client.get_latest_order_book_formatted("Xbt", "Usd"))
+
+        await self.client._unsubscribe("ticker-xbtusd")
+        self.assertIsNone(self.client.get_latest_ticker("Xbt", "Usd"))
+        self.assertIsNone(self.client.get_latest_ticker_formatted("Xbt", "Usd"))
+        # Other channels for the pair keep their data
+        self.assertIsNotNone(self.client.get_latest_order_book_formatted("Xbt", "Usd"))
+
+        # A resubscribed ticker reuses the pair's slot
+        await self.client.ensure_subscribed("ticker-xbtusd")
+        self.client._handle_frame(b'{"n":"ticker-xbtusd","o":{"PrimaryCurrencyCode":"Xbt","SecondaryCurrencyCode":"Usd","BestBid":2.0}}')
+        self.assertEqual(self.client.get_latest_ticker("Xbt", "Usd"), {
+            "PrimaryCurrencyCode": "Xbt", "SecondaryCurrencyCode": "Usd", "BestBid": 2.0})
+        self.assertEqual(len(self.client._ticker_pairs), 1)
+
+    async def test_manage_subscriptions_survives_closed_connection(self):
+        self.client.websocket = MagicMock(state=State.OPEN)
+        self.client.websocket.send.side_effect = ConnectionClosed(None, None)
+        self.client._running = True
+        self.client.active_subscriptions = {"ticker-xbtusd"}
+        self.client._schedule_expiry("ticker-xbtusd", time.time() - 1)
+
+        task = asyncio.create_task(self.client._manage_subscriptions())
+        await asyncio.sleep(0.01)
+
+        # The manager keeps running and retries the unsubscribe later
+        self.assertFalse(task.done())
+        self.assertEqual(self.client.active_subscriptions, {"ticker-xbtusd"})
+        self.assertEqual([channel for _, channel in self.client._expiry_heap], ["ticker-xbtusd"])
+        self.assertGreater(self.client._expiry_heap[0][0], time.time())
+
+        task.cancel()
+
+    def test_queue_batch_waits_for_room(self):
+        loop = MagicMock()
+        self.client._running = True
+        self.client._frames = MagicMock()
+        self.client._batch_slots = threading.Semaphore(1)
+
+        self.client._queue_batch(loop, [b"first"])
+        reader = threading.Thread(target=self.client._queue_batch, args=(loop, [b"second"]))
+        reader.start()
+        reader.join(0.1)
+
+        # The reader blocks until the event loop takes a batch off the queue
+        self.assertTrue(reader.is_alive())
+        self.assertEqual(loop.call_soon_threadsafe.call_count, 1)
+        self.client._batch_slots.release()
+        reader.join(2)
+        self.assertEqual(loop.call_soon_threadsafe.call_count, 2)
+
+    async def test_connect_against_local_server(self):
+        connections = []
+        received = []
+
+        async def handler(websocket):
+            connections.append(websocket)
+            async for message in websocket:
+                received.append((len(connections), message))
+                channel = json.loads(message)["n"]
+                await websocket.send(json.dumps({"n": channel, "o": {
+                    "PrimaryCurrencyCode": "Xbt", "SecondaryCurrencyCode": "Usd", "LastPrice": float(len(connections))}}))
+
+        async def wait_for(condition):
+            for _ in range(200):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+            self.fail("timed out")
+
+        with patch("ir_client.RECONNECT_DELAY", 0), \
+                patch.object(self.client, "_load_currency_codes", AsyncMock()):
+            async with serve(handler, "127.0.0.1", 0) as server:
+                self.client.ws_url = "ws://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+                task = asyncio.create_task(self.client.connect())
+                await wait_for(lambda: self.client.connected)
+
+                self.client.request(self.client.market_channel("ticker", "Xbt", "Usd"))
+                await wait_for(lambda: self.client.get_latest_ticker("Xbt", "Usd") is not None)
+                self.assertEqual(self.client.get_latest_ticker("Xbt", "Usd")["LastPrice"], 1.0)
+
+                # After the server drops the connection the client reconnects and
+                # resubscribes on its own
+                await connections[0].close()
+                await wait_for(lambda: len(received) == 2)
+                self.assertEqual(received[1], (2, '{"m":"subscribe","n":"ticker-xbtusd"}'))
+                await wait_for(lambda: self.client.get_latest_ticker("Xbt", "Usd")["LastPrice"] == 2.0)
+
+                self.client.stop()
+                await asyncio.wait_for(task, 5)
+                self.assertFalse(self.client.connected)
+
+                # The background tasks are cancelled and let go of
+                await asyncio.sleep(0)
+                self.assertEqual(self.client._tasks, set())
+
+    async def test_currency_codes_load_retried_on_reconnect(self):
+        available = False
+
+        async def codes(request):
+            if not available:
+                return web.Response(status=503)
+            if request.path.endswith("GetValidPrimaryCurrencyCodes"):
+                return web.json_response(["Xbt", "Eth"])
+            return web.json_response(["Usd", "Aud"])
+
+        connections = []
+        received = []
+
+        async def handler(websocket):
+            connections.append(websocket)
+            async for message in websocket:
+                received.append(message)
+
+        async def wait_for(condition):
+            for _ in range(200):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+            self.fail("timed out")
 
-            for msg in messages:
-                await self.client._handle_message(msg)
+        app = web.Application()
+        app.router.add_get("/Public/{method}", codes)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self.addAsyncCleanup(runner.cleanup)
+        self.client.rest_url = "http://127.0.0.1:%d/Public" % runner.addresses[0][1]
 
-            # Check that the data was cached correctly
-            self.assertIn("xbtusd", self.client.tickers)
-            self.assertEqual(self.client.tickers["xbtusd"]["LastPrice"], 50000.0)
+        with patch("ir_client.RECONNECT_DELAY", 0):
+            async with serve(handler, "127.0.0.1", 0) as server:
+                self.client.ws_url = "ws://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+                self.client.request("ticker-xbtusd")
+                task = asyncio.create_task(self.client.connect())
 
-            self.assertIn("ethaud", self.client.order_books)
-            self.assertEqual(self.client.order_books["ethaud"]["BuyOrders"][0]["Price"], 3000)
+                # The subscribe is sent once the first connect has been handled
+                await wait_for(lambda: received and self.client._codes_task.done())
+                self.assertIsNone(self.client._primary_codes)
+                self.assertTrue(self.client.is_valid_pair("Foo", "Usd"))
 
-            self.assertIn("btcusd", self.client.recent_trades)
-            self.assertEqual(self.client.recent_trades["btcusd"]["Trades"][0]["Price"], 60000)
+                available = True
+                await connections[0].close()
+                await wait_for(lambda: self.client._primary_codes is not None)
+                self.assertFalse(self.client.is_valid_pair("Foo", "Usd"))
 
-        asyncio.run(run_test())
+                self.client.stop()
+                await asyncio.wait_for(task, 5)
 
 if __name__ == '__main__':
     unittest.main()
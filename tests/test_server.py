@@ -5,57 +5,118 @@ from unittest.mock import AsyncMock, MagicMock, patch
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from server import handle_call_tool
+from websockets.protocol import State
+
+from ir_client import ORDER_BOOK, RECENT_TRADES, TICKER, IndependentReserveWebSocketClient
+from formatting import format_order_book_data, format_recent_trades_data, format_ticker_data
+from server import handle_call_tool, handle_list_tools
 
 class TestServer(unittest.IsolatedAsyncioTestCase):
     @patch('server.ir_client', new_callable=AsyncMock)
     async def test_get_ticker(self, mock_ir_client):
-        # Configure the synchronous method with MagicMock
-        mock_ir_client.get_latest_ticker = MagicMock(return_value={
+        mock_ir_client.request = MagicMock()
+        mock_ir_client.is_valid_pair = MagicMock(return_value=True)
+        mock_ir_client.market_channel = MagicMock(return_value="ticker-xbtusd")
+        mock_ir_client.get_latest_ticker_formatted = MagicMock(return_value=format_ticker_data({
             "PrimaryCurrencyCode": "Xbt",
             "SecondaryCurrencyCode": "Usd",
             "LastPrice": 52000.0,
-        })
+        }))
 
         result = await handle_call_tool("get_ticker", {"primary_currency": "xbt", "secondary_currency": "usd"})
 
         self.assertIn("Ticker for Xbt/Usd", result[0].text)
         self.assertIn("52000.0", result[0].text)
-        mock_ir_client.subscribe_ticker.assert_awaited_once_with("xbt", "usd")
+        mock_ir_client.market_channel.assert_called_once_with(TICKER, "xbt", "usd")
+        mock_ir_client.request.assert_called_once_with("ticker-xbtusd")
 
     @patch('server.ir_client', new_callable=AsyncMock)
     async def test_get_order_book(self, mock_ir_client):
-        mock_ir_client.get_latest_order_book = MagicMock(return_value={
+        mock_ir_client.request = MagicMock()
+        mock_ir_client.is_valid_pair = MagicMock(return_value=True)
+        mock_ir_client.market_channel = MagicMock(return_value="orderbook-ethaud")
+        mock_ir_client.get_latest_order_book_formatted = MagicMock(return_value=format_order_book_data({
             "PrimaryCurrencyCode": "Eth",
             "SecondaryCurrencyCode": "Aud",
             "BuyOrders": [{"Price": 3000, "Volume": 10}],
             "SellOrders": [{"Price": 3100, "Volume": 10}],
-        })
+        }))
 
         result = await handle_call_tool("get_order_book", {"primary_currency": "eth", "secondary_currency": "aud"})
 
         self.assertIn("Order Book for Eth/Aud", result[0].text)
         self.assertIn("3000", result[0].text)
-        mock_ir_client.subscribe_order_book.assert_awaited_once_with("eth", "aud")
+        mock_ir_client.market_channel.assert_called_once_with(ORDER_BOOK, "eth", "aud")
+        mock_ir_client.request.assert_called_once_with("orderbook-ethaud")
 
     @patch('server.ir_client', new_callable=AsyncMock)
     async def test_get_recent_trades(self, mock_ir_client):
-        mock_ir_client.get_latest_recent_trades = MagicMock(return_value={
+        mock_ir_client.request = MagicMock()
+        mock_ir_client.is_valid_pair = MagicMock(return_value=True)
+        mock_ir_client.market_channel = MagicMock(return_value="recenttrades-btcusd")
+        mock_ir_client.get_latest_recent_trades_formatted = MagicMock(return_value=format_recent_trades_data({
             "PrimaryCurrencyCode": "Btc",
             "SecondaryCurrencyCode": "Usd",
             "Trades": [{"Price": 60000, "Volume": 0.5}],
-        })
+        }))
 
         result = await handle_call_tool("get_recent_trades", {"primary_currency": "btc", "secondary_currency": "usd"})
 
         self.assertIn("Recent Trades for Btc/Usd", result[0].text)
         self.assertIn("60000", result[0].text)
-        mock_ir_client.subscribe_recent_trades.assert_awaited_once_with("btc", "usd")
+        mock_ir_client.market_channel.assert_called_once_with(RECENT_TRADES, "btc", "usd")
+        mock_ir_client.request.assert_called_once_with("recenttrades-btcusd")
+
+    async def test_expired_subscription_is_not_served(self):
+        client = IndependentReserveWebSocketClient()
+        client.websocket = MagicMock(state=State.OPEN)
+        arguments = {"primary_currency": "eth", "secondary_currency": "aud"}
+
+        with patch('server.ir_client', client):
+            await client.ensure_subscribed(client.market_channel(ORDER_BOOK, "eth", "aud"))
+            client._handle_frame(b'{"n":"orderbook-ethaud","o":{"PrimaryCurrencyCode":"Eth","SecondaryCurrencyCode":"Aud","BuyOrders":[{"Price":3000,"Volume":10}]}}')
+            result = await handle_call_tool("get_order_book", arguments)
+            self.assertIn("3000", result[0].text)
+
+            # Once the subscription expires the old book is no longer returned
+            await client._unsubscribe("orderbook-ethaud")
+            result = await handle_call_tool("get_order_book", arguments)
+            self.assertEqual("Data for eth/aud is not available yet. Please try again in a moment.", result[0].text)
+
+    @patch('server.ir_client', new_callable=AsyncMock)
+    async def test_invalid_pair(self, mock_ir_client):
+        mock_ir_client.is_valid_pair = MagicMock(return_value=False)
+        mock_ir_client.request = MagicMock()
+
+        result = await handle_call_tool("get_ticker", {"primary_currency": "foo", "secondary_currency": "usd"})
+
+        self.assertEqual("Invalid currency pair: foo/usd. Please check the currency codes and try again.", result[0].text)
+        mock_ir_client.is_valid_pair.assert_called_once_with("foo", "usd")
+        mock_ir_client.request.assert_not_called()
+
+    @patch('server.ir_client', new_callable=AsyncMock)
+    async def test_get_my_balance_not_ready(self, mock_ir_client):
+        mock_ir_client.request = MagicMock()
+        mock_ir_client.get_my_balance = MagicMock(return_value={})
+
+        result = await handle_call_tool("get_my_balance", {})
+
+        self.assertEqual("Balance data is not available yet. Please try again in a moment.", result[0].text)
+        mock_ir_client.request.assert_called_once_with("balance")
+
+        # Repeat polls get the same reply back
+        self.assertIs(await handle_call_tool("get_my_balance", {}), result)
 
     @patch('server.ir_client', new_callable=AsyncMock)
     async def test_unknown_tool(self, mock_ir_client):
         result = await handle_call_tool("unknown_tool", {"primary_currency": "btc", "secondary_currency": "usd"})
         self.assertEqual("Unknown tool.", result[0].text)
 
+    async def test_list_tools(self):
+        tools = await handle_list_tools()
+
+        self.assertEqual([tool.name for tool in tools], ["get_ticker", "get_recent_trades", "get_order_book", "get_my_balance"])
+        self.assertIs(tools, await handle_list_tools())
+
 if __name__ == '__main__':
     unittest.main()